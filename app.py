@@ -1,7 +1,15 @@
 import json
+import math
+import os
 from flask import Flask, jsonify, request
 from db import db, User, Book, Genre
-import datetime
+import clients
+import db_routing
+import geo
+import housekeeping
+import locations_dao
+import migrations
+import rate_limiter
 import users_dao  
 
 
@@ -11,9 +19,46 @@ db_filename = "/usr/app/book.db"
 # Database configuration
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///books.db"  # Update with your database URI
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# GET requests read through this engine, set READ_DATABASE_URI to use a replica
+app.config["SQLALCHEMY_BINDS"] = {
+    db_routing.READ_BIND_KEY: os.environ.get("READ_DATABASE_URI", app.config["SQLALCHEMY_DATABASE_URI"]),
+}
+# How long a client's reads stay on the primary after it writes (0 disables)
+app.config["READ_YOUR_WRITES_SECONDS"] = 5
+
+# Rate limiting configuration, state is shared between workers through the local store
+app.config["LOCAL_STORE_PATH"] = os.path.join(app.instance_path, "local_store.db")
+app.config["RATE_LIMIT_ENABLED"] = True
+# name: (requests, seconds), applied per authenticated user and per IP
+app.config["RATE_LIMITS"] = {
+    "register": (5, 60),
+    "login": (10, 60),
+    "session": (30, 60),
+    "create_user": (5, 60),
+    "like": (30, 60),
+    "write": (60, 60),
+}
+# name: max requests in flight across all workers (bcrypt routes)
+app.config["CONCURRENCY_LIMITS"] = {
+    "register": 4,
+    "login": 8,
+    "create_user": 4,
+}
+app.config["CONCURRENCY_LEASE_SECONDS"] = 30
+
+# Expired sessions are purged in the background, in batches (interval 0 disables)
+app.config["SESSION_SWEEP_INTERVAL_SECONDS"] = 60
+app.config["SESSION_SWEEP_BATCH_SIZE"] = 500
 
 # Initialize the database
 db.init_app(app)
+db_routing.init_app(app, db, clients.client_keys)
+
+# Start background jobs once per serving process. When run as a script with the
+# debug reloader, this module also runs in the watcher process, which never
+# serves requests; only the reloader's child has WERKZEUG_RUN_MAIN set
+if __name__ != "__main__" or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+    housekeeping.start_session_sweeper(app)
 
 # Base route
 @app.route("/")
@@ -76,6 +121,7 @@ def get_books_by_genre(genre_name):
 
 # Route 8: Create a new user
 @app.route("/user/", methods=["POST"])
+@rate_limiter.limit("create_user")
 def create_user():
     body = json.loads(request.data)
     username = body.get("username")
@@ -83,9 +129,13 @@ def create_user():
     profile_photo = body.get("profile_photo")
     location = body.get("location")
     email = body.get("email")
+    latitude = body.get("latitude")
+    longitude = body.get("longitude")
 
     if not username or not password:
         return json.dumps({"error": "Username and password are required"}), 400
+    if (latitude is not None or longitude is not None) and not geo.valid_coordinates(latitude, longitude):
+        return json.dumps({"error": "Invalid latitude or longitude"}), 400
 
     # Check if the user already exists
     existing_user = User.query.filter_by(username=username).first()
@@ -98,7 +148,9 @@ def create_user():
         password=password,
         profile_photo = profile_photo,
         location = location,
-        email = email
+        email = email,
+        latitude = latitude,
+        longitude = longitude
     )
     
     db.session.add(new_user)
@@ -108,6 +160,7 @@ def create_user():
 
 # Route 9: Create a new book
 @app.route("/book/<int:user_id>/", methods=["POST"])
+@rate_limiter.limit("write")
 def create_book(user_id):
     body = json.loads(request.data)
     title = body.get("title")
@@ -116,6 +169,8 @@ def create_book(user_id):
     image = body.get("image")
     quote = body.get("quote")
     genre_name = body.get("genre")
+    latitude = body.get("latitude")
+    longitude = body.get("longitude")
     genre = Genre.query.filter_by(genre=genre_name).first()
     user = User.query.filter_by(id=user_id).first()
 
@@ -123,6 +178,8 @@ def create_book(user_id):
         return json.dumps({"error": "User not found"}), 404
     if genre is None:
         return json.dumps({"error": "Genre not found"}), 404
+    if (latitude is not None or longitude is not None) and not geo.valid_coordinates(latitude, longitude):
+        return json.dumps({"error": "Invalid latitude or longitude"}), 400
 
     new_book = Book(
         title=title,
@@ -131,7 +188,9 @@ def create_book(user_id):
         image = image,
         quote = quote,
         genre=genre, 
-        posted_by_user=user
+        posted_by_user=user,
+        latitude=latitude,
+        longitude=longitude
     )
     db.session.add(new_book)
     user.posted_books.append(new_book)
@@ -142,6 +201,7 @@ def create_book(user_id):
 
 # Route 10: Edit an existing book
 @app.route("/book/<int:book_id>/edit/", methods=["POST"])
+@rate_limiter.limit("write")
 def edit_book(book_id):
     body = json.loads(request.data)
     name = body.get("name")
@@ -149,15 +209,20 @@ def edit_book(book_id):
     genre_name = body.get("genre")
     genre = Genre.query.filter_by(genre=genre_name).first()
     photos = body.get("photos")
+    latitude = body.get("latitude")
+    longitude = body.get("longitude")
 
     book = Book.query.filter_by(id=book_id).first()
     if book is None:
         return json.dumps({"error": "Book not found"}), 404
+    if (latitude is not None or longitude is not None) and not geo.valid_coordinates(latitude, longitude):
+        return json.dumps({"error": "Invalid latitude or longitude"}), 400
 
     if name is not None: book.name = name
     if description is not None: book.description = description
     if genre is not None: book.genre = genre
     if photos is not None: book.photos = photos
+    if latitude is not None: book.set_coordinates(latitude, longitude)
 
     db.session.commit()
 
@@ -165,6 +230,7 @@ def edit_book(book_id):
 
 # Route 11: Like (bookmark) a book
 @app.route("/book/<int:user_id>/<int:book_id>/like/", methods=["POST"])
+@rate_limiter.limit("like")
 def like_book(user_id, book_id):
     user = User.query.filter_by(id=user_id).first()
     book = Book.query.filter_by(id=book_id).first()
@@ -185,6 +251,7 @@ def like_book(user_id, book_id):
 
 # Route 12: Create genre
 @app.route("/genre/", methods=["POST"])
+@rate_limiter.limit("write")
 def create_genre():
     body = json.loads(request.data)
     genre = body.get("genre")
@@ -203,6 +270,7 @@ def create_genre():
 
 #Route 13: Delete user
 @app.route("/user/<int:user_id>/", methods=["DELETE"])
+@rate_limiter.limit("write")
 def delete_user(user_id):
     user = User.query.filter_by(id=user_id).first()
     if user is None:
@@ -214,6 +282,7 @@ def delete_user(user_id):
 
 #Route 14: Delete book
 @app.route("/book/<int:book_id>/", methods=["DELETE"])
+@rate_limiter.limit("write")
 def delete_book(book_id):
     book = Book.query.filter_by(id=book_id).first()
     if book is None:
@@ -225,6 +294,7 @@ def delete_book(book_id):
 
 #Route 15: Delete genre
 @app.route("/genre/<string:genre_name>/", methods=["DELETE"])
+@rate_limiter.limit("write")
 def delete_genre(genre_name):
     genre = Genre.query.filter_by(genre=genre_name).first()
     if genre is None:
@@ -234,6 +304,82 @@ def delete_genre(genre_name):
     db.session.commit()
     return json.dumps(genre.serialize()), 200
 
+# Route 16: Return the books near a location, nearest first
+@app.route("/books/nearby/", methods=["GET"])
+def get_nearby_books():
+    return nearby_response(Book, "nearby_books")
+
+
+# Route 17: Return the users near a location, nearest first
+@app.route("/users/nearby/", methods=["GET"])
+def get_nearby_users():
+    return nearby_response(User, "nearby_users")
+
+
+def nearby_response(model, key):
+    """
+    Shared handler for the nearby routes
+
+    Query parameters: lat and lon (required), radius in km (optional, at most
+    MAX_RADIUS_KM) and k, the maximum number of results (optional, at most
+    MAX_RESULTS, defaults to 10)
+    """
+    latitude = request.args.get("lat")
+    longitude = request.args.get("lon")
+    if not geo.valid_coordinates(latitude, longitude):
+        return json.dumps({"error": "Valid lat and lon are required"}), 400
+    latitude = float(latitude)
+    longitude = float(longitude)
+
+    radius = request.args.get("radius")
+    k = request.args.get("k", "10")
+    try:
+        radius = float(radius) if radius is not None else None
+    except ValueError:
+        radius = math.nan
+    try:
+        k = int(k)
+    except ValueError:
+        k = 0
+
+    if radius is not None and not (0 < radius <= locations_dao.MAX_RADIUS_KM):
+        return json.dumps({"error": f"radius must be between 0 and {locations_dao.MAX_RADIUS_KM:g} km"}), 400
+    if not (0 < k <= locations_dao.MAX_RESULTS):
+        return json.dumps({"error": f"k must be between 1 and {locations_dao.MAX_RESULTS}"}), 400
+
+    # Distances are between ~1 km cell centres (see locations_dao.SNAP_PRECISION),
+    # so no set of queries can locate a user more precisely than their cell
+    if radius is not None:
+        results = locations_dao.within_radius(model, latitude, longitude, radius, k)
+    else:
+        results = locations_dao.nearest(model, latitude, longitude, k)
+
+    return json.dumps({key: [
+        {**row.simple_serialize(), "distance_km": round(distance)} for row, distance in results
+    ]}), 200
+
+# Route 18: Set (or clear, with null coordinates) a user's location
+@app.route("/user/<int:user_id>/location/", methods=["POST"])
+@rate_limiter.limit("write")
+def set_user_location(user_id):
+    body = json.loads(request.data)
+    latitude = body.get("latitude")
+    longitude = body.get("longitude")
+    location = body.get("location")
+
+    user = User.query.filter_by(id=user_id).first()
+    if user is None:
+        return json.dumps({"error": "User not found"}), 404
+    if (latitude is not None or longitude is not None) and not geo.valid_coordinates(latitude, longitude):
+        return json.dumps({"error": "Invalid latitude or longitude"}), 400
+
+    user.set_coordinates(latitude, longitude)
+    if location is not None: user.location = location
+    db.session.commit()
+
+    return json.dumps(user.simple_serialize()), 200
+
+
 # Route Like and Match: User Likes a Book, and then Checks if a Matching Happens with the person who posted the book (kinda like a tinder match). 
 def Like_And_Matching(user_id, book_id):
     #double check:
@@ -314,7 +460,7 @@ def extract_token(request):
     """
     Helper function that extracts the token from the header of a request
     """
-    auth_header = request.header.get("Authorization")
+    auth_header = request.headers.get("Authorization")
     if auth_header is None:
         return False, json.dumps({"error": "missing auth header."})
     bearer_token = auth_header.replace("Bearer", "").strip()
@@ -324,6 +470,7 @@ def extract_token(request):
 
 
 @app.route("/register/", methods=["POST"])
+@rate_limiter.limit("register")
 def register_account():
     """
     Endpoint for registering a new user
@@ -331,26 +478,25 @@ def register_account():
     body = json.loads(request.data)
     email = body.get("email")
     password = body.get("password")
+    latitude = body.get("latitude")
+    longitude = body.get("longitude")
 
     if email is None or password is None:
         return json.dumps({"error": "Invalid email or password."})
+    if (latitude is not None or longitude is not None) and not geo.valid_coordinates(latitude, longitude):
+        return json.dumps({"error": "Invalid latitude or longitude"}), 400
     
-    created, user = users_dao.create_user(email, password)
+    created, user = users_dao.create_user(email, password, latitude, longitude)
 
     if not created:
         return json.dumps({"error": "User already exists."})
     
-    return json.dumps({
-
-        "session_token": user.session_token,
-        "session_expiration": str(user.session_expiration),
-        "update_token": user.update_token,
-
-    })
-    pass
+    session = users_dao.create_session(user)
+    return json.dumps(session.serialize())
 
 
 @app.route("/login/", methods=["POST"])
+@rate_limiter.limit("login")
 def login():
     """
     Endpoint for logging in a user
@@ -367,15 +513,12 @@ def login():
     if not success:
         return json.dumps({"error": "Incorrect Email/Password."}), 400
     
-    return json.dumps(
-        {
-        "session_token": user.session_token,
-        "session_expiration": str(user.session_expiration),
-        "update_token": user.update_token,
-        }
-    )
+    # Each login gets its own session, so other devices stay logged in
+    session = users_dao.create_session(user)
+    return json.dumps(session.serialize())
     
 @app.route("/session/", methods=["POST"])
+@rate_limiter.limit("session")
 def update_session():
     """
     Endpoint for updating a user's session
@@ -384,18 +527,12 @@ def update_session():
     if not success:
         return update_token
     
-    user = users_dao.renew_session(update_token)
+    session = users_dao.renew_session(update_token)
 
-    if user is None:
+    if session is None:
         return json.dumps({"error": "invalid update token."})
     
-    return json.dumps(
-        {
-        "session_token": user.session_token,
-        "session_expiration": str(user.session_expiration),
-        "update_token": user.update_token,
-        }
-    )
+    return json.dumps(session.serialize())
     
 @app.route("/secret/", methods=["GET"])
 def secret_message():
@@ -409,15 +546,16 @@ def secret_message():
     if not success: 
         return session_token
     
-    user = users_dao.get_user_by_session_token(session_token)
+    session = users_dao.get_session_by_session_token(session_token)
 
-    if user is None or not user.verify_session_token(session_token):
+    if session is None or not session.verify_session_token(session_token):
         return json.dumps({"error": "Invalid session token."})
     
     return json.dumps({"message": "Implemented Session Token."}), 200
 
 
 @app.route("/logout/", methods=["POST"])
+@rate_limiter.limit("write")
 def logout():
     """
     Endpoint for logging out a user
@@ -426,14 +564,14 @@ def logout():
     if not success:
         return session_token
     
-    user = users_dao.get_user_by_session_token(session_token)
-    if not user or not user.verify_session_token(session_token):
+    session = users_dao.get_session_by_session_token(session_token)
+    if not session or not session.verify_session_token(session_token):
         return json.dumps({"error": "Invalid Session Token."}), 400
-    user.session_expiration = datetime.datetime.now()
-    db.session.commit()
+    users_dao.delete_session(session)
     return json.dumps({"message": "User has successfully logged out."})
 
 if __name__ == "__main__":
     with app.app_context():
         db.create_all()  # Create tables if they don't exist
+        migrations.upgrade()  # Bring tables from older versions up to date
     app.run(host="0.0.0.0", port=8000, debug=True)
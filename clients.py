@@ -0,0 +1,34 @@
+"""
+Clients file
+
+Helper file for identifying the client behind a request, shared by the rate
+limiter and read-your-writes routing
+"""
+
+from flask import g, request
+
+import users_dao
+
+
+def client_keys():
+    """
+    Returns the keys identifying the client of the current request: the user of
+    its session token if the token is valid, and its IP address
+
+    Ids in the URL are never used, since anyone can put any id there
+    """
+    if "client_keys" in g:
+        return g.client_keys
+
+    keys = []
+
+    auth_header = request.headers.get("Authorization")
+    token = auth_header.replace("Bearer", "").strip() if auth_header else None
+    if token:
+        session = users_dao.get_session_by_session_token(token)
+        if session is not None and session.verify_session_token(token):
+            keys.append(f"user:{session.user_id}")
+
+    keys.append(f"ip:{request.remote_addr}")
+    g.client_keys = keys
+    return keys
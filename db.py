@@ -3,8 +3,10 @@ import hashlib
 import os
 import bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from db_routing import RoutingSession
+import geo
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 
 # Association table for bookmarked and posted books
 user_books_association = db.Table(
@@ -21,6 +23,23 @@ friendships = db.Table(
     db.Column('friend_id', db.Integer, db.ForeignKey('users.id'))
 )
 
+def set_coordinates(entry, latitude, longitude):
+    """
+    Sets latitude/longitude on a User or Book and recomputes its geohash
+
+    Clears all three if either coordinate is missing
+    """
+    if latitude is None or longitude is None:
+        entry.latitude = None
+        entry.longitude = None
+        entry.geohash = None
+        return
+
+    entry.latitude = float(latitude)
+    entry.longitude = float(longitude)
+    entry.geohash = geo.encode(entry.latitude, entry.longitude)
+
+
 class User(db.Model):
     """
     User Model
@@ -32,14 +51,18 @@ class User(db.Model):
     profile_photo = db.Column(db.String, nullable=True)
     location = db.Column(db.String, nullable=True)
 
+    # Structured location, geohash is indexed for nearby queries.
+    # Exact coordinates are never serialized, nearby results only give distances between ~1 km cells
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
+    geohash = db.Column(db.String(geo.MAX_PRECISION), nullable=True, index=True)
+
     # User information
     email = db.Column(db.String, nullable=False, unique=True)
     password_digest = db.Column(db.String, nullable=False)
 
-    # Session information
-    session_token = db.Column(db.String, nullable=False, unique=True)
-    session_expiration = db.Column(db.DateTime, nullable=False)
-    update_token = db.Column(db.String, nullable=False, unique=True)
+    # Session information, one row per logged in device
+    sessions = db.relationship("UserSession", back_populates="user", cascade="delete")
 
     bookmarked_books = db.relationship(
         "Book", secondary=user_books_association, back_populates="bookmarked_by_users"
@@ -63,8 +86,8 @@ class User(db.Model):
         self.profile_photo = kwargs.get("profile_photo")
         self.location = kwargs.get("location")
         self.email = kwargs.get("email")
+        self.set_coordinates(kwargs.get("latitude"), kwargs.get("longitude"))
         self.password_digest = bcrypt.hashpw(kwargs.get("password").encode("utf8"), bcrypt.gensalt(rounds=13))
-        self.renew_session()
 
     def serialize(self):
         """
@@ -93,6 +116,54 @@ class User(db.Model):
             "email": self.email
         }
 
+    def set_coordinates(self, latitude, longitude):
+        """
+        Sets the user's coordinates and keeps the geohash index in sync
+        """
+        set_coordinates(self, latitude, longitude)
+
+    def verify_password(self, password):
+        """
+        Verifies the password of a user
+        """
+        return bcrypt.checkpw(password.encode("utf8"), self.password_digest)
+
+
+class UserSession(db.Model):
+    """
+    UserSession Model
+
+    Kept apart from the users table so renewing or checking a session only
+    touches this narrow table and its token indexes
+    """
+    __tablename__ = "sessions"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False, index=True)
+    user = db.relationship("User", back_populates="sessions")
+
+    session_token = db.Column(db.String, nullable=False, unique=True)
+    session_expiration = db.Column(db.DateTime, nullable=False)
+    update_token = db.Column(db.String, nullable=False, unique=True)
+    # Once this passes neither token is usable and the sweeper deletes the row
+    update_expiration = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __init__(self, **kwargs):
+        """
+        Initialize UserSession object/entry
+        """
+        self.user = kwargs.get("user")
+        self.renew_session()
+
+    def serialize(self):
+        """
+        Serialize a UserSession object
+        """
+        return {
+            "session_token": self.session_token,
+            "session_expiration": str(self.session_expiration),
+            "update_token": self.update_token,
+        }
+
     def _urlsafe_base_64(self):
         """
         Randomly generates hashed tokens (used for session/update tokens)
@@ -103,30 +174,25 @@ class User(db.Model):
         """
         Renews the sessions, i.e.
         1. Creates a new session token
-        2. Sets the expiration time of the session to be a day from now
-        3. Creates a new update token
+        2. Sets the expiration time of the session to be a minute from now
+        3. Creates a new update token, valid for a day
         """
         self.session_token = self._urlsafe_base_64()
         self.session_expiration = datetime.datetime.now() + datetime.timedelta(minutes=1)
         self.update_token = self._urlsafe_base_64()
-
-    def verify_password(self, password):
-        """
-        Verifies the password of a user
-        """
-        return bcrypt.checkpw(password.encode("utf8"), self.password_digest)
+        self.update_expiration = datetime.datetime.now() + datetime.timedelta(days=1)
 
     def verify_session_token(self, session_token):
         """
-        Verifies the session token of a user
+        Verifies the session token of a session
         """
         return session_token == self.session_token and datetime.datetime.now() < self.session_expiration
 
     def verify_update_token(self, update_token):
         """
-        Verifies the update token of a user
+        Verifies the update token of a session
         """
-        return update_token == self.update_token
+        return update_token == self.update_token and datetime.datetime.now() < self.update_expiration
 
 
 class Book(db.Model):
@@ -142,6 +208,12 @@ class Book(db.Model):
     image = db.Column(db.String, nullable=True)
     quote = db.Column(db.String, nullable=True)
 
+    # Structured location, geohash is indexed for nearby queries.
+    # Exact coordinates are never serialized, nearby results only give distances between ~1 km cells
+    latitude = db.Column(db.Float, nullable=True)
+    longitude = db.Column(db.Float, nullable=True)
+    geohash = db.Column(db.String(geo.MAX_PRECISION), nullable=True, index=True)
+
     genre_id = db.Column(db.Integer, db.ForeignKey("genres.id"))  # Foreign key for genre
     genre = db.relationship("Genre", back_populates="books")
 
@@ -164,6 +236,14 @@ class Book(db.Model):
         self.genre = kwargs.get("genre")
         self.posted_by_user = kwargs.get("posted_by_user")
 
+        # Books default to where the user who posted them is
+        latitude = kwargs.get("latitude")
+        longitude = kwargs.get("longitude")
+        if (latitude is None or longitude is None) and self.posted_by_user is not None:
+            latitude = self.posted_by_user.latitude
+            longitude = self.posted_by_user.longitude
+        self.set_coordinates(latitude, longitude)
+
     def serialize(self):
         """
         Serialize a book object
@@ -192,6 +272,12 @@ class Book(db.Model):
             "quote": self.quote,
         }
 
+    def set_coordinates(self, latitude, longitude):
+        """
+        Sets the book's coordinates and keeps the geohash index in sync
+        """
+        set_coordinates(self, latitude, longitude)
+
 
 class Genre(db.Model):
     __tablename__ = "genres"
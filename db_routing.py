@@ -0,0 +1,139 @@
+"""
+DB routing file
+
+Sends reads and writes to different engines:
+
+1. Queries made while handling a GET/HEAD request go to the "read" bind, a
+   read-only engine (a replica, or the primary opened with PRAGMA query_only).
+2. Everything else (mutations, flushes, work outside a request) goes to the primary.
+3. Once a client writes, its reads stick to the primary for READ_YOUR_WRITES_SECONDS
+   so it always sees its own changes. The marker is kept in the local store so
+   it holds across worker processes.
+"""
+
+import logging
+import random
+import sqlite3
+import time
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.sql.selectable import CompoundSelect, Select
+
+import local_store
+
+logger = logging.getLogger(__name__)
+
+READ_BIND_KEY = "read"
+READ_METHODS = {"GET", "HEAD"}
+
+# Write markers older than this are no longer useful and can be dropped
+RECENT_WRITES_TTL_SECONDS = 60 * 60
+
+
+class RoutingSession(Session):
+    """
+    Session that picks the read engine for reads made by GET requests
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        """
+        Select the read engine for plain SELECTs when it is safe to, otherwise the
+        usual engine (so DML, text() and anything unrecognised go to the primary)
+        """
+        if (
+            bind is None
+            and not self._flushing
+            and isinstance(clause, (Select, CompoundSelect))
+            and use_read_engine()
+        ):
+            engines = self._db.engines
+            if READ_BIND_KEY in engines:
+                return engines[READ_BIND_KEY]
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def use_read_engine():
+    """
+    Returns true if the current request may read from the read engine
+    """
+    return (
+        has_request_context()
+        and request.method in READ_METHODS
+        and not g.get("read_your_writes", False)
+    )
+
+
+def mark_write(keys):
+    """
+    Records that the clients identified by keys have just written
+    """
+    now = time.time()
+    with local_store.transaction() as conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO recent_writes (key, written_at) VALUES (?, ?)",
+            [(key, now) for key in keys],
+        )
+        if random.random() < 0.001:
+            conn.execute(
+                "DELETE FROM recent_writes WHERE written_at < ?", (now - RECENT_WRITES_TTL_SECONDS,)
+            )
+
+
+def wrote_recently(keys, window):
+    """
+    Returns true if any of the clients identified by keys wrote in the last window seconds
+    """
+    placeholders = ", ".join("?" for _ in keys)
+    row = local_store.connection().execute(
+        f"SELECT 1 FROM recent_writes WHERE key IN ({placeholders}) AND written_at > ? LIMIT 1",
+        (*keys, time.time() - window),
+    ).fetchone()
+    return row is not None
+
+
+def _set_query_only(dbapi_connection, connection_record):
+    """
+    Makes every new SQLite connection of the read engine refuse writes
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only = ON")
+    cursor.close()
+
+
+def init_app(app, db, client_keys):
+    """
+    Sets up read/write routing for app
+
+    Expects the "read" bind in SQLALCHEMY_BINDS and db to use RoutingSession.
+    client_keys() returns the keys identifying the current request's client
+    """
+    with app.app_context():
+        read_engine = db.engines[READ_BIND_KEY]
+    if read_engine.dialect.name == "sqlite":
+        event.listen(read_engine, "connect", _set_query_only)
+
+    @app.before_request
+    def check_read_your_writes():
+        window = app.config["READ_YOUR_WRITES_SECONDS"]
+        if request.method not in READ_METHODS or not window:
+            return
+        try:
+            g.read_your_writes = wrote_recently(client_keys(), window)
+        except sqlite3.Error:
+            logger.exception("Local store unavailable, reading from primary")
+            g.read_your_writes = True
+
+    @app.after_request
+    def record_write(response):
+        if request.method in READ_METHODS or request.method == "OPTIONS" or response.status_code >= 400:
+            return response
+        if not app.config["READ_YOUR_WRITES_SECONDS"]:
+            return response
+        try:
+            mark_write(client_keys())
+        except sqlite3.Error:
+            logger.exception("Could not record write for read-your-writes")
+        return response
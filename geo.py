@@ -0,0 +1,183 @@
+"""
+Geo helper file
+
+Helper functions for encoding coordinates as geohashes and measuring distances.
+Geohashes are stored in an indexed column, so "what is near this point" becomes a
+handful of prefix range scans over a B-tree instead of a full table scan.
+"""
+
+import math
+
+BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+MAX_PRECISION = 12
+# Upper bound on the number of prefix range scans a single search does
+MAX_CELLS = 16
+EARTH_RADIUS_KM = 6371.0088
+# Length of one degree of latitude on the sphere distance_km measures on
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180.0
+
+
+def encode(latitude, longitude, precision=MAX_PRECISION):
+    """
+    Encodes a latitude/longitude pair as a geohash string of the given precision
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    even = True
+
+    while len(geohash) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if longitude >= mid:
+                bits = (bits << 1) | 1
+                lon_range[0] = mid
+            else:
+                bits = bits << 1
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if latitude >= mid:
+                bits = (bits << 1) | 1
+                lat_range[0] = mid
+            else:
+                bits = bits << 1
+                lat_range[1] = mid
+        even = not even
+        bit_count += 1
+
+        if bit_count == 5:
+            geohash.append(BASE32[bits])
+            bits = 0
+            bit_count = 0
+
+    return "".join(geohash)
+
+
+def cell_size(precision):
+    """
+    Returns the (height, width) in degrees of a geohash cell of the given precision
+    """
+    lat_bits = (5 * precision) // 2
+    lon_bits = 5 * precision - lat_bits
+    return 180.0 / (2 ** lat_bits), 360.0 / (2 ** lon_bits)
+
+
+def cell_center(latitude, longitude, precision):
+    """
+    Returns the centre of the geohash cell of the given precision containing the point
+    """
+    height, width = cell_size(precision)
+    row = min(int((latitude + 90.0) // height), round(180.0 / height) - 1)
+    col = min(int((longitude + 180.0) // width), round(360.0 / width) - 1)
+    return -90.0 + (row + 0.5) * height, -180.0 + (col + 0.5) * width
+
+
+def cell_diagonal_km(precision):
+    """
+    Returns the largest diagonal, in km, of a geohash cell of the given precision
+    (cells are widest at the equator)
+    """
+    height, width = cell_size(precision)
+    return math.hypot(height, width) * KM_PER_DEGREE
+
+
+def bounding_box(latitude, longitude, radius_km):
+    """
+    Returns (lat_min, lat_max, lon_span) of a box containing every point within
+    radius_km, where the box covers longitude +/- lon_span (180 means all of it)
+    """
+    d_lat = radius_km / KM_PER_DEGREE
+    lat_min = max(latitude - d_lat, -90.0)
+    lat_max = min(latitude + d_lat, 90.0)
+
+    # Measured at the most poleward edge, so the span is never too narrow
+    lat_scale = math.cos(math.radians(max(abs(lat_min), abs(lat_max))))
+    if lat_scale <= 1e-9:
+        return lat_min, lat_max, 180.0
+    return lat_min, lat_max, min(radius_km / (KM_PER_DEGREE * lat_scale), 180.0)
+
+
+def equirectangular_slack(radius_km, lon_span):
+    """
+    Returns how many times larger an equirectangular distance can be than the
+    true great-circle distance, for two points in a bounding box of radius_km
+    and lon_span whose longitude is scaled at the box's most poleward latitude
+
+    Follows from sin(x) >= x * sin(X) / X for 0 <= x <= X, applied to the half
+    latitude and longitude differences in the haversine formula
+    """
+    def sin_ratio(x):
+        return math.sin(x) / x if x > 0 else 1.0
+
+    half_lat = radius_km / EARTH_RADIUS_KM / 2
+    half_lon = math.radians(min(lon_span, 90.0))
+    # The small extra factor absorbs floating point error
+    return (1.0 + 1e-9) / min(sin_ratio(half_lat), sin_ratio(half_lon))
+
+
+def covering_cells(latitude, longitude, radius_km):
+    """
+    Returns a set of geohash prefixes that together cover every point within radius_km
+
+    Uses the longest precision that needs at most MAX_CELLS cells (falling back
+    to precision 1, at most 32 cells), so the set is never empty and each prefix
+    is one range scan on the geohash index
+    """
+    lat_min, lat_max, lon_span = bounding_box(latitude, longitude, radius_km)
+
+    chosen = None
+    for precision in range(1, MAX_PRECISION + 1):
+        height, width = cell_size(precision)
+        lat_rows = round(180.0 / height)
+        lon_cols = round(360.0 / width)
+
+        rows = range(
+            min(int((lat_min + 90.0) // height), lat_rows - 1),
+            min(int((lat_max + 90.0) // height), lat_rows - 1) + 1,
+        )
+        if lon_span >= 180.0:
+            cols = range(lon_cols)
+        else:
+            cols = range(
+                int((longitude - lon_span + 180.0) // width),
+                int((longitude + lon_span + 180.0) // width) + 1,
+            )
+
+        if chosen is not None and len(rows) * min(len(cols), lon_cols) > MAX_CELLS:
+            break
+        chosen = (precision, height, width, rows, cols, lon_cols)
+
+    precision, height, width, rows, cols, lon_cols = chosen
+    return {
+        encode(-90.0 + (row + 0.5) * height, -180.0 + (col % lon_cols + 0.5) * width, precision)
+        for row in rows
+        for col in cols
+    }
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """
+    Returns the great-circle (haversine) distance between two points in kilometres
+    """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    d_phi = math.radians(lat2 - lat1)
+    d_lambda = math.radians(lon2 - lon1)
+
+    a = math.sin(d_phi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def valid_coordinates(latitude, longitude):
+    """
+    Returns true if latitude and longitude are numbers within their valid ranges
+    """
+    try:
+        latitude = float(latitude)
+        longitude = float(longitude)
+    except (TypeError, ValueError):
+        return False
+    return -90.0 <= latitude <= 90.0 and -180.0 <= longitude <= 180.0
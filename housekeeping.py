@@ -0,0 +1,54 @@
+"""
+Housekeeping file
+
+Background jobs that keep the database tidy while the app is running
+"""
+
+import logging
+import threading
+import time
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from db import db
+import users_dao
+
+logger = logging.getLogger(__name__)
+
+
+def sweep_sessions(app):
+    """
+    Deletes expired sessions once, returning how many were removed
+    """
+    with app.app_context():
+        try:
+            return users_dao.delete_expired_sessions(app.config["SESSION_SWEEP_BATCH_SIZE"])
+        except SQLAlchemyError:
+            db.session.rollback()
+            logger.exception("Session sweep failed, will retry next interval")
+            return 0
+        finally:
+            db.session.remove()
+
+
+def start_session_sweeper(app):
+    """
+    Starts a daemon thread that sweeps expired sessions every
+    SESSION_SWEEP_INTERVAL_SECONDS (0 disables it)
+
+    Returns the thread, or None if disabled
+    """
+    interval = app.config["SESSION_SWEEP_INTERVAL_SECONDS"]
+    if not interval:
+        return None
+
+    def run():
+        while True:
+            time.sleep(interval)
+            deleted = sweep_sessions(app)
+            if deleted:
+                logger.info("Deleted %d expired sessions", deleted)
+
+    thread = threading.Thread(target=run, name="session-sweeper", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,84 @@
+"""
+Local store file
+
+A small SQLite database, separate from the main one, for state that has to be
+shared between worker processes on the same host (e.g. rate limiter buckets
+and read-your-writes markers). Every process/thread opens its own connection to
+the file set in the LOCAL_STORE_PATH config value.
+"""
+
+import contextlib
+import os
+import sqlite3
+import threading
+
+from flask import current_app
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS rate_buckets (
+        key TEXT PRIMARY KEY,
+        tokens REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS inflight (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        name TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_inflight_name_expires_at ON inflight (name, expires_at)",
+    """
+    CREATE TABLE IF NOT EXISTS recent_writes (
+        key TEXT PRIMARY KEY,
+        written_at REAL NOT NULL
+    )
+    """,
+]
+
+_local = threading.local()
+
+
+def connection():
+    """
+    Returns this thread's connection to the local store, opening it if needed
+    """
+    path = current_app.config["LOCAL_STORE_PATH"]
+    conn = getattr(_local, "conn", None)
+
+    # Connections must not be shared with forked worker processes
+    if conn is not None and (_local.pid != os.getpid() or _local.path != path):
+        conn = None
+
+    if conn is None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            conn.execute(statement)
+        _local.conn = conn
+        _local.pid = os.getpid()
+        _local.path = path
+
+    return conn
+
+
+@contextlib.contextmanager
+def transaction():
+    """
+    Runs the enclosed block in a write transaction, so read-modify-write
+    updates are atomic across processes
+    """
+    conn = connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
@@ -0,0 +1,154 @@
+"""
+DAO (Data Access Object) file
+
+Helper file containing functions for nearby (location based) queries.
+
+Candidates are narrowed in SQL by range scans on the indexed geohash column and a
+conservative approximate (equirectangular) distance. A LIMITed window, ordered by
+approximate distance, tells how far the wanted rows reach, and only candidates
+within that distance are loaded and re-ranked by exact distance. So the work done
+per query grows with the number of results rather than the size of the table.
+"""
+
+import math
+
+from sqlalchemy import and_, case, func, or_
+
+import geo
+
+# Largest radius and number of results a single search may ask for
+MAX_RADIUS_KM = 500.0
+MAX_RESULTS = 100
+
+# Nearest-neighbour searches start at this radius and double until they have enough results
+KNN_START_RADIUS_KM = 1.0
+
+# Rows fetched per requested result in the first, approximately ordered window
+CANDIDATE_FACTOR = 2
+
+# Distances are measured between the centres of geohash cells of this precision
+# (about 1.2 x 0.6 km), for the query point and every row alike. Results then only
+# depend on which cells the points are in, so no sequence of queries can locate
+# a user more precisely than their cell.
+SNAP_PRECISION = 6
+# Snapping moves a distance by at most this much, so searches widen by it
+SNAP_SLACK_KM = geo.cell_diagonal_km(SNAP_PRECISION)
+
+
+def _approximate_distance_sq(model, latitude, longitude, radius_km):
+    """
+    Returns a SQL expression for the squared equirectangular distance (km^2) from
+    the point to each row, and the largest value it can take for a row that is
+    really within radius_km
+
+    Longitude is scaled at the most poleward latitude in range, so the estimate
+    is only ever too large by geo.equirectangular_slack, which the bound allows for
+    """
+    lat_min, lat_max, lon_span = geo.bounding_box(latitude, longitude, radius_km)
+    lat_scale = math.cos(math.radians(max(abs(lat_min), abs(lat_max))))
+
+    d_lat = (model.latitude - latitude) * geo.KM_PER_DEGREE
+    d_lon = func.abs(model.longitude - longitude)
+    d_lon = case((d_lon > 180.0, 360.0 - d_lon), else_=d_lon) * (geo.KM_PER_DEGREE * lat_scale)
+
+    bound = radius_km * geo.equirectangular_slack(radius_km, lon_span)
+    return d_lat * d_lat + d_lon * d_lon, bound * bound
+
+
+def _ordering_distance_sq(model, latitude, longitude):
+    """
+    Returns a SQL expression for the squared equirectangular distance (km^2) from
+    the point to each row, with longitude scaled at the point's own latitude
+
+    Only used to order candidates: unlike the filter expression it treats every
+    direction alike, so the nearest rows come first
+    """
+    lat_scale = math.cos(math.radians(latitude))
+
+    d_lat = (model.latitude - latitude) * geo.KM_PER_DEGREE
+    d_lon = func.abs(model.longitude - longitude)
+    d_lon = case((d_lon > 180.0, 360.0 - d_lon), else_=d_lon) * (geo.KM_PER_DEGREE * lat_scale)
+    return d_lat * d_lat + d_lon * d_lon
+
+
+def _candidates(model, latitude, longitude, radius_km):
+    """
+    Returns a query for the rows of model that may be within radius_km
+    """
+    # "~" sorts after every geohash character, so each range is one prefix
+    cells = geo.covering_cells(latitude, longitude, radius_km)
+    approximate_distance_sq, bound_sq = _approximate_distance_sq(model, latitude, longitude, radius_km)
+
+    return model.query.filter(
+        or_(*[and_(model.geohash >= cell, model.geohash < cell + "~") for cell in cells]),
+        approximate_distance_sq <= bound_sq,
+    )
+
+
+def _rank(rows, latitude, longitude, radius_km):
+    """
+    Returns a list of (row, distance_km) for the rows whose cell centre is within
+    radius_km of the (already snapped) point, nearest first
+    """
+    results = []
+    for row in rows:
+        row_latitude, row_longitude = geo.cell_center(row.latitude, row.longitude, SNAP_PRECISION)
+        distance = geo.distance_km(latitude, longitude, row_latitude, row_longitude)
+        if distance <= radius_km:
+            results.append((row, distance))
+
+    results.sort(key=lambda result: (result[1], result[0].id))
+    return results
+
+
+def within_radius(model, latitude, longitude, radius_km, limit=MAX_RESULTS):
+    """
+    Returns a list of (row, distance_km) for at most limit rows of model within
+    radius_km, nearest first, measured between cell centres (see SNAP_PRECISION)
+
+    Loads a window of the approximately nearest candidates first. If the window
+    was full it may have missed rows that sorted too late, so every candidate
+    within the distance of the limit-th result is then loaded and re-ranked
+    """
+    latitude, longitude = geo.cell_center(latitude, longitude, SNAP_PRECISION)
+
+    window = limit * CANDIDATE_FACTOR
+    rows = (
+        _candidates(model, latitude, longitude, radius_km + SNAP_SLACK_KM)
+        .order_by(_ordering_distance_sq(model, latitude, longitude))
+        .limit(window)
+        .all()
+    )
+    results = _rank(rows, latitude, longitude, radius_km)
+    if len(rows) < window:
+        return results[:limit]
+
+    bound_km = results[limit - 1][1] if len(results) >= limit else radius_km
+    rows = _candidates(model, latitude, longitude, bound_km + SNAP_SLACK_KM).all()
+    return _rank(rows, latitude, longitude, radius_km)[:limit]
+
+
+def count_within_radius(model, latitude, longitude, radius_km, limit):
+    """
+    Counts the candidates of model within radius_km, stopping once limit are found
+    """
+    return _candidates(model, latitude, longitude, radius_km).limit(limit).count()
+
+
+def nearest(model, latitude, longitude, k):
+    """
+    Returns a list of (row, distance_km) for the k rows of model closest to the point
+    (up to MAX_RADIUS_KM away), nearest first
+
+    The radius grows by counting candidates in each ring, and rows are only loaded
+    once the ring holds k of them
+    """
+    radius_km = KNN_START_RADIUS_KM
+    while radius_km < MAX_RADIUS_KM:
+        if count_within_radius(model, latitude, longitude, radius_km, k) >= k:
+            results = within_radius(model, latitude, longitude, radius_km, k)
+            if len(results) >= k:
+                return results
+        radius_km *= 2
+
+    return within_radius(model, latitude, longitude, MAX_RADIUS_KM, k)
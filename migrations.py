@@ -0,0 +1,117 @@
+"""
+Migrations file
+
+Upgrades a database created by an older version of the app in place.
+db.create_all() only creates missing tables, so columns, indexes and data moved
+within existing tables are handled here. Every step checks the current schema
+first, so upgrade() is safe to run on every start (after db.create_all()).
+"""
+
+import datetime
+
+from sqlalchemy import MetaData, Table, and_, inspect, literal, select, text
+
+from db import db, User, UserSession, Book
+import geo
+
+BACKFILL_BATCH_SIZE = 1000
+
+# Session columns that used to live on the users table
+OLD_SESSION_COLUMNS = ("session_token", "session_expiration", "update_token")
+
+
+def upgrade():
+    """
+    Runs every migration step against the primary database
+    """
+    with db.engine.begin() as conn:
+        add_location_columns(conn)
+        move_sessions_out_of_users(conn)
+
+
+def _columns(conn, table_name):
+    """
+    Returns the names of the columns a table currently has
+    """
+    return {column["name"] for column in inspect(conn).get_columns(table_name)}
+
+
+def add_location_columns(conn):
+    """
+    Adds latitude/longitude/geohash and the geohash index to users and books,
+    then fills in any missing geohashes
+    """
+    for model in (User, Book):
+        table = model.__table__
+        columns = _columns(conn, table.name)
+
+        for name in ("latitude", "longitude", "geohash"):
+            if name not in columns:
+                column_type = table.c[name].type.compile(conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {name} {column_type}"))
+
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+        _backfill_geohash(conn, table)
+
+
+def _backfill_geohash(conn, table):
+    """
+    Computes the geohash of rows that have coordinates but no geohash, in batches
+    """
+    missing = and_(table.c.geohash.is_(None), table.c.latitude.isnot(None), table.c.longitude.isnot(None))
+    while True:
+        rows = conn.execute(
+            select(table.c.id, table.c.latitude, table.c.longitude).where(missing).limit(BACKFILL_BATCH_SIZE)
+        ).fetchall()
+        if not rows:
+            return
+
+        for row_id, latitude, longitude in rows:
+            conn.execute(
+                table.update().where(table.c.id == row_id).values(geohash=geo.encode(latitude, longitude))
+            )
+
+
+def move_sessions_out_of_users(conn):
+    """
+    Copies each user's tokens from the old users columns into the sessions table,
+    then removes those NOT NULL UNIQUE columns, which new user rows can't fill
+    """
+    if "session_token" not in _columns(conn, User.__tablename__):
+        return
+
+    old_users = Table(User.__tablename__, MetaData(), autoload_with=conn)
+    sessions = UserSession.__table__
+
+    # Old update tokens never expired, give them the normal lifetime from now
+    update_expiration = datetime.datetime.now() + datetime.timedelta(days=1)
+    conn.execute(sessions.insert().from_select(
+        ["user_id", "session_token", "session_expiration", "update_token", "update_expiration"],
+        select(
+            old_users.c.id,
+            old_users.c.session_token,
+            old_users.c.session_expiration,
+            old_users.c.update_token,
+            literal(update_expiration, sessions.c.update_expiration.type),
+        ).where(old_users.c.session_token.isnot(None), old_users.c.update_token.isnot(None)),
+    ))
+
+    if conn.dialect.name != "sqlite":
+        for name in OLD_SESSION_COLUMNS:
+            conn.execute(text(f"ALTER TABLE {old_users.name} DROP COLUMN {name}"))
+        return
+
+    # SQLite can't drop UNIQUE columns, so rebuild the table without them
+    new_users = User.__table__.to_metadata(MetaData(), name="users_new")
+    new_users.indexes.clear()
+    new_users.create(conn)
+
+    kept = ", ".join(name for name in old_users.c.keys() if name in User.__table__.c)
+    conn.execute(text(f"INSERT INTO users_new ({kept}) SELECT {kept} FROM {old_users.name}"))
+    conn.execute(text(f"DROP TABLE {old_users.name}"))
+    conn.execute(text(f"ALTER TABLE users_new RENAME TO {old_users.name}"))
+
+    for index in User.__table__.indexes:
+        index.create(conn, checkfirst=True)
@@ -0,0 +1,148 @@
+"""
+Rate limiter file
+
+Admission control for the write and auth endpoints:
+
+1. Token buckets keyed by the client's authenticated user and by IP address.
+   Limits come from the RATE_LIMITS config, {name: (requests, seconds)}, and a
+   rejected request gets a 429 with Retry-After.
+2. Concurrency limits for expensive routes (e.g. bcrypt hashing). Limits come from
+   the CONCURRENCY_LIMITS config, {name: max_in_flight}, and a request over the
+   limit is shed with a 503 with Retry-After.
+
+State lives in the local store so every worker process sees the same limits.
+"""
+
+import functools
+import json
+import logging
+import math
+import random
+import sqlite3
+import time
+
+from flask import current_app
+
+import clients
+import local_store
+
+logger = logging.getLogger(__name__)
+
+# Buckets untouched for this long are full again and can be dropped
+BUCKET_IDLE_SECONDS = 60 * 60
+
+
+def take_tokens(name, keys, requests, seconds):
+    """
+    Takes a token from the bucket of each key for limit name
+
+    Tokens are only taken if every bucket has one. Returns whether the request is
+    allowed, and if not, how many seconds until it would be
+    """
+    rate = requests / seconds
+    now = time.time()
+
+    with local_store.transaction() as conn:
+        buckets = []
+        retry_after = 0
+        for key in keys:
+            bucket_key = f"{name}:{key}"
+            row = conn.execute(
+                "SELECT tokens, updated_at FROM rate_buckets WHERE key = ?", (bucket_key,)
+            ).fetchone()
+            tokens = requests if row is None else min(requests, row[0] + (now - row[1]) * rate)
+            if tokens < 1:
+                retry_after = max(retry_after, (1 - tokens) / rate)
+            buckets.append((bucket_key, tokens))
+
+        if retry_after:
+            return False, retry_after
+
+        conn.executemany(
+            "INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+            [(bucket_key, tokens - 1, now) for bucket_key, tokens in buckets],
+        )
+
+        if random.random() < 0.001:
+            conn.execute(
+                "DELETE FROM rate_buckets WHERE updated_at < ?", (now - BUCKET_IDLE_SECONDS,)
+            )
+
+    return True, 0
+
+
+def acquire_slot(name, limit):
+    """
+    Claims one of the limit in-flight slots for name
+
+    Returns the slot id, or None if all slots are taken. Slots expire after
+    CONCURRENCY_LEASE_SECONDS so a crashed worker can't leak them
+    """
+    now = time.time()
+    lease = current_app.config["CONCURRENCY_LEASE_SECONDS"]
+
+    with local_store.transaction() as conn:
+        conn.execute("DELETE FROM inflight WHERE name = ? AND expires_at < ?", (name, now))
+        (in_flight,) = conn.execute(
+            "SELECT COUNT(*) FROM inflight WHERE name = ?", (name,)
+        ).fetchone()
+        if in_flight >= limit:
+            return None
+        return conn.execute(
+            "INSERT INTO inflight (name, expires_at) VALUES (?, ?)", (name, now + lease)
+        ).lastrowid
+
+
+def release_slot(slot_id):
+    """
+    Releases an in-flight slot claimed by acquire_slot
+    """
+    with local_store.transaction() as conn:
+        conn.execute("DELETE FROM inflight WHERE id = ?", (slot_id,))
+
+
+def limit(name):
+    """
+    Decorator applying the rate and concurrency limits configured for name to a route
+
+    Routes sharing a name share their limits. If the local store can't be reached
+    requests are let through rather than failing.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if not current_app.config.get("RATE_LIMIT_ENABLED", True):
+                return f(*args, **kwargs)
+
+            rate_limit = current_app.config["RATE_LIMITS"].get(name)
+            max_in_flight = current_app.config["CONCURRENCY_LIMITS"].get(name)
+            slot_id = None
+
+            try:
+                if rate_limit is not None:
+                    allowed, retry_after = take_tokens(name, clients.client_keys(), *rate_limit)
+                    if not allowed:
+                        return json.dumps({"error": "Too many requests."}), 429, {
+                            "Retry-After": str(math.ceil(retry_after))
+                        }
+
+                if max_in_flight is not None:
+                    slot_id = acquire_slot(name, max_in_flight)
+                    if slot_id is None:
+                        return json.dumps({"error": "Server is busy, try again shortly."}), 503, {
+                            "Retry-After": "1"
+                        }
+            except sqlite3.Error:
+                logger.exception("Rate limiter store unavailable, admitting request")
+
+            try:
+                return f(*args, **kwargs)
+            finally:
+                if slot_id is not None:
+                    try:
+                        release_slot(slot_id)
+                    except sqlite3.Error:
+                        logger.exception("Could not release in-flight slot, it will expire")
+
+        return wrapper
+    return decorator
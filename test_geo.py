@@ -0,0 +1,166 @@
+"""
+Tests for the geohash helpers and nearby queries, checked against a brute-force
+haversine scan between snapped cell centres
+
+Run with: python -m unittest test_geo
+"""
+
+import math
+import os
+import random
+import tempfile
+import unittest
+
+from flask import Flask
+
+from db import db, User, Book, Genre
+import geo
+import locations_dao
+
+
+def destination(latitude, longitude, distance_km, bearing):
+    """
+    Returns the point distance_km away from (latitude, longitude) along bearing (degrees)
+    """
+    angle = distance_km / geo.EARTH_RADIUS_KM
+    phi = math.radians(latitude)
+    theta = math.radians(bearing)
+
+    phi2 = math.asin(math.sin(phi) * math.cos(angle) + math.cos(phi) * math.sin(angle) * math.cos(theta))
+    lambda2 = math.radians(longitude) + math.atan2(
+        math.sin(theta) * math.sin(angle) * math.cos(phi),
+        math.cos(angle) - math.sin(phi) * math.sin(phi2),
+    )
+    return math.degrees(phi2), (math.degrees(lambda2) + 180.0) % 360.0 - 180.0
+
+
+class GeohashTest(unittest.TestCase):
+
+    def test_encode(self):
+        self.assertEqual(geo.encode(57.64911, 10.40744, 11), "u4pruydqqvj")
+        self.assertEqual(geo.encode(-90.0, -180.0, 5), "00000")
+        self.assertEqual(geo.encode(40.7128, -74.0060, 5), "dr5re")
+
+    def test_degree_length_matches_haversine(self):
+        self.assertAlmostEqual(geo.distance_km(0.0, 0.0, 1.0, 0.0), geo.KM_PER_DEGREE, places=6)
+
+    def test_covering_cells_contain_every_point_in_radius(self):
+        rng = random.Random(1)
+        for _ in range(300):
+            latitude, longitude = rng.uniform(-89.9, 89.9), rng.uniform(-180.0, 180.0)
+            radius = rng.choice([0.05, 1.0, 25.0, 500.0]) * rng.uniform(0.5, 1.0)
+            cells = geo.covering_cells(latitude, longitude, radius)
+            self.assertLessEqual(len(cells), 32)
+
+            for _ in range(20):
+                point = destination(latitude, longitude, radius * rng.uniform(0.0, 0.9999), rng.uniform(0.0, 360.0))
+                geohash = geo.encode(*point)
+                self.assertTrue(any(geohash.startswith(cell) for cell in cells), (latitude, longitude, radius, point))
+
+
+class NearbyQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = Flask(__name__)
+        self.app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(self.directory.name, "test.db")
+        db.init_app(self.app)
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        owner = User(username="owner", password="password", email="owner@example.com")
+        self.genre = Genre(genre="fiction")
+        db.session.add_all([owner, self.genre])
+        db.session.commit()
+        self.owner = owner
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+        self.directory.cleanup()
+
+    def add_books(self, points):
+        for latitude, longitude in points:
+            db.session.add(Book(
+                title="book", author="author", genre=self.genre, posted_by_user=self.owner,
+                latitude=latitude, longitude=longitude,
+            ))
+        db.session.commit()
+
+    def brute_force(self, latitude, longitude):
+        snap = locations_dao.SNAP_PRECISION
+        query = geo.cell_center(latitude, longitude, snap)
+        return sorted(
+            (geo.distance_km(*query, *geo.cell_center(book.latitude, book.longitude, snap)), book.id)
+            for book in Book.query.all()
+        )
+
+    def assert_matches_brute_force(self, latitude, longitude, radius, limit=100):
+        found = locations_dao.within_radius(Book, latitude, longitude, radius, limit)
+        expected = [book_id for distance, book_id in self.brute_force(latitude, longitude) if distance <= radius]
+        self.assertEqual([book.id for book, _ in found], expected[:limit], (latitude, longitude, radius))
+
+    def test_rows_at_the_edge_of_the_radius_are_found(self):
+        rng = random.Random(3)
+        for radius in (1.0, 500.0):
+            self.add_books([
+                destination(40.0, -74.0, radius * rng.uniform(0.995, 1.005), rng.uniform(0.0, 360.0))
+                for _ in range(50)
+            ])
+            self.assert_matches_brute_force(40.0, -74.0, radius)
+
+    def test_results_do_not_depend_on_position_within_a_cell(self):
+        self.add_books([destination(40.0, -74.0, 0.4 * i, 45.0 * i) for i in range(1, 20)])
+        height, width = geo.cell_size(locations_dao.SNAP_PRECISION)
+        latitude, longitude = geo.cell_center(40.0, -74.0, locations_dao.SNAP_PRECISION)
+
+        def search(d_lat, d_lon):
+            return [
+                (book.id, distance)
+                for book, distance in locations_dao.within_radius(Book, latitude + d_lat, longitude + d_lon, 3.0)
+            ]
+
+        baseline = search(0.0, 0.0)
+        self.assertTrue(baseline)
+        for d_lat, d_lon in ((0.45 * height, 0.0), (0.0, -0.45 * width), (-0.4 * height, 0.4 * width)):
+            self.assertEqual(search(d_lat, d_lon), baseline)
+
+    def test_nearest_rows_in_any_direction_are_found(self):
+        # East-west rows look closer than north-south ones to the filter expression,
+        # enough of them to fill the first candidate window
+        self.add_books(
+            [destination(60.0, 10.0, 10.0, 0.0)]
+            + [destination(60.0, 10.0, 10.2 + 0.03 * i, 90.0) for i in range(12)]
+        )
+        north = Book.query.first()
+
+        found = locations_dao.within_radius(Book, 60.0, 10.0, 500.0, 5)
+        self.assertIn(north.id, [book.id for book, _ in found])
+        self.assert_matches_brute_force(60.0, 10.0, 500.0, 5)
+
+    def test_radius_and_nearest_match_brute_force(self):
+        rng = random.Random(2)
+        centres = [(40.0, -74.0), (60.0, 10.0), (-33.9, 151.2), (0.0, 179.9), (85.0, 0.0)]
+        points = []
+        for latitude, longitude in centres:
+            for _ in range(150):
+                points.append(destination(latitude, longitude, rng.uniform(0.0, 600.0), rng.uniform(0.0, 360.0)))
+        self.add_books(points)
+
+        for latitude, longitude in centres:
+            query = destination(latitude, longitude, rng.uniform(0.0, 50.0), rng.uniform(0.0, 360.0))
+            expected = self.brute_force(*query)
+
+            for radius in (1.0, 30.0, 200.0, 500.0):
+                self.assert_matches_brute_force(query[0], query[1], radius)
+
+            for k in (1, 5, 20):
+                found = locations_dao.nearest(Book, query[0], query[1], k)
+                nearest = [book_id for distance, book_id in expected if distance <= locations_dao.MAX_RADIUS_KM]
+                self.assertEqual([book.id for book, _ in found], nearest[:k], (query, k))
+
+
+if __name__ == "__main__":
+    unittest.main()
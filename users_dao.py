@@ -4,7 +4,9 @@ DAO (Data Access Object) file
 Helper file containing functions for accessing data in our database
 """
 
-from db import db, User
+import datetime
+
+from db import db, User, UserSession
 
 
 def get_user_by_email(email):
@@ -14,18 +16,18 @@ def get_user_by_email(email):
     return User.query.filter(User.email == email).first()
 
 
-def get_user_by_session_token(session_token):
+def get_session_by_session_token(session_token):
     """
-    Returns a user object from the database given a session token
+    Returns a UserSession object from the database given a session token
     """
-    return User.query.filter(User.session_token == session_token).first()
+    return UserSession.query.filter(UserSession.session_token == session_token).first()
 
 
-def get_user_by_update_token(update_token):
+def get_session_by_update_token(update_token):
     """
-    Returns a user object from the database given an update token
+    Returns a UserSession object from the database given an update token
     """
-    return User.query.filter(User.update_token == update_token).first()
+    return UserSession.query.filter(UserSession.update_token == update_token).first()
 
 
 def verify_credentials(email, password):
@@ -40,9 +42,9 @@ def verify_credentials(email, password):
     return optional_user.verify_password(password), optional_user
 
 
-def create_user(email, password):
+def create_user(email, password, latitude=None, longitude=None):
     """
-    Creates a User object in the database
+    Creates a User object in the database, optionally with coordinates
 
     Returns if creation was successful, and the User object
     """
@@ -51,23 +53,69 @@ def create_user(email, password):
     if optional_user is not None:
         return False, optional_user
     
-    user = User(email=email, password=password)
+    user = User(email=email, password=password, latitude=latitude, longitude=longitude)
 
     db.session.add(user)
     db.session.commit()
     return True, user
 
 
+def create_session(user):
+    """
+    Starts a new session for a user, alongside any sessions on other devices
+
+    Returns the UserSession object
+    """
+    session = UserSession(user=user)
+    db.session.add(session)
+    db.session.commit()
+    return session
+
+
 def renew_session(update_token):
     """
-    Renews a user's session token
-    
-    Returns the User object
+    Renews a session's tokens
+
+    Returns the UserSession object, or None if the update token is invalid or expired
     """
-    user = get_user_by_update_token(update_token)
-    if user is None:
+    session = get_session_by_update_token(update_token)
+    if session is None or not session.verify_update_token(update_token):
         return None
-    
-    user.renew_session()
+
+    session.renew_session()
     db.session.commit()
-    return user
+    return session
+
+
+def delete_session(session):
+    """
+    Ends a session (i.e. logs out that device)
+    """
+    db.session.delete(session)
+    db.session.commit()
+
+
+def delete_expired_sessions(batch_size):
+    """
+    Deletes sessions whose update token has expired, batch_size rows per transaction
+    so the write lock is never held for long
+
+    Returns the number of sessions deleted
+    """
+    deleted = 0
+    while True:
+        now = datetime.datetime.now()
+        expired_ids = [
+            session_id for (session_id,) in db.session.query(UserSession.id)
+            .filter(UserSession.update_expiration < now)
+            .limit(batch_size)
+        ]
+        if not expired_ids:
+            return deleted
+
+        UserSession.query.filter(UserSession.id.in_(expired_ids)).delete(synchronize_session=False)
+        db.session.commit()
+        deleted += len(expired_ids)
+
+        if len(expired_ids) < batch_size:
+            return deleted